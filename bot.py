@@ -1,7 +1,20 @@
 import os
+import atexit
 import logging
+import queue
 import re
+import contextlib
+import copy
+import ctypes
+import gc
+import shutil
+import sys
+import tempfile
+import threading
 import asyncio
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from urllib.parse import urlparse
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -11,7 +24,9 @@ from telegram.ext import (
     ContextTypes,
 )
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import ThrottledDownload
 from dotenv import load_dotenv
+from cachetools import TTLCache
 
 # Enable basic logging
 logging.basicConfig(
@@ -19,19 +34,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def start_log_listener():
+    # Hand records to a background thread so handlers never block on stream writes
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 # Load environment variables
 load_dotenv()
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# BOT_TOKEN is accepted too, since older deployment docs used that name
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("BOT_TOKEN")
+# When set, Telegram pushes updates to this public HTTPS URL instead of the bot polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
-# Command handlers
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "Send a URL to download a video, audio, or image from any platform."
-    )
-    logger.info(f"Start command by user {update.message.from_user.id}")
+WELCOME_TEXT = "Send a URL to download a video, audio, or image from any platform."
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = """
+HELP_TEXT = """
     **VideoDownloaderBot**
 
     Send a URL to download a video, audio, or image from any platform.
@@ -46,7 +68,236 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     After sending a URL, choose Video, Audio, or Image to download.
     """
-    await update.message.reply_text(help_text)
+
+def retry_backoff(attempt):
+    # Exponential delay between yt-dlp retries (1, 2, 4, ... s), capped at 30 s
+    return min(2 ** attempt, 30)
+
+# Options shared by every yt-dlp call
+YDL_BASE_OPTS = {
+    "quiet": True,
+    "no-check-certificate": True,
+    "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "geo_bypass": True,
+    "noplaylist": True,
+    "retries": 3,
+    "extractor_retries": 1,
+    # Back off instead of retrying immediately, e.g. after an HTTP 429 from the site
+    "retry_sleep_functions": {
+        "http": retry_backoff,
+        "fragment": retry_backoff,
+        "extractor": retry_backoff,
+    },
+    "concurrent_fragment_downloads": 4,  # Parallel HLS/DASH fragments
+    "throttledratelimit": 100 * 1024,  # Re-extract when a download stalls below 100 KB/s (see download())
+    "buffersize": 64 * 1024,
+    # Player JS / signature cache; None keeps yt-dlp's default (~/.cache/yt-dlp)
+    "cachedir": os.getenv("YTDLP_CACHE_DIR"),
+}
+
+# Seconds allowed for sending a request body; a 50 MB upload needs far more than the 5-20 s defaults
+UPLOAD_TIMEOUT = 120
+
+# Per media type: extra yt-dlp options, Telegram's upload limit and the not-found reply
+MEDIA_TYPES = {
+    "video": {
+        "ydl_opts": {"format": "bestvideo+bestaudio/best"},
+        "max_mb": 50,
+        "not_found": "Error: Video file not found.",
+    },
+    "audio": {
+        "ydl_opts": {"format": "bestaudio/best"},
+        "max_mb": 50,
+        "not_found": "Error: Audio file not found.",
+    },
+    "image": {
+        "ydl_opts": {
+            "writethumbnail": True,
+            "skip_download": True,  # Only download thumbnail
+        },
+        "max_mb": 10,
+        "not_found": "Error: No image found. Ensure the URL contains a downloadable image.",
+    },
+}
+
+# A message consisting of a single http(s) URL
+URL_RE = re.compile(r"^\s*https?://\S+\s*$")
+
+# Matches a media-type reply ("Video", "audio", ...) in one pass
+MEDIA_TYPE_RE = re.compile(r"^\s*(?:%s)\s*$" % "|".join(MEDIA_TYPES), re.IGNORECASE)
+
+# Caps how many yt-dlp jobs run in worker threads at once
+YDL_SEMAPHORE = asyncio.Semaphore(5)
+
+# At most two jobs per site at a time, so bursts don't get the bot's IP rate-limited.
+# Maps host -> [semaphore, holders]; an entry is dropped once nobody holds or waits on it.
+HOST_SEMAPHORES = {}
+
+@contextlib.asynccontextmanager
+async def host_semaphore(url):
+    host = (urlparse(url).hostname or "").removeprefix("www.")
+    slot = HOST_SEMAPHORES.get(host)
+    if slot is None:
+        slot = HOST_SEMAPHORES[host] = [asyncio.Semaphore(2), 0]
+    slot[1] += 1
+    try:
+        async with slot[0]:
+            yield
+    finally:
+        slot[1] -= 1
+        if not slot[1]:
+            del HOST_SEMAPHORES[host]
+
+# Unprocessed extractor results and their session cookies keyed by URL,
+# so re-sent links skip the network round-trip
+INFO_CACHE = TTLCache(maxsize=1024, ttl=600)
+
+# One extraction-only YoutubeDL per worker thread, reused across requests
+YDL_LOCAL = threading.local()
+
+def extract_info(url):
+    ydl = getattr(YDL_LOCAL, "ydl", None)
+    if ydl is None:
+        ydl = YDL_LOCAL.ydl = YoutubeDL(YDL_BASE_OPTS)
+    # Start from an empty jar so the snapshot only holds this extraction's cookies
+    ydl.cookiejar.clear()
+    info = ydl.extract_info(url, download=False, process=False)
+    return info, list(ydl.cookiejar)
+
+def replayable(info):
+    # Unresolved url results and playlists (entries may be a generator) can only be processed once
+    return info.get("_type", "video") == "video"
+
+async def get_info(url):
+    # Returns (info, cookies); only single videos are cached for later requests
+    entry = INFO_CACHE.get(url)
+    if entry is None:
+        async with host_semaphore(url), YDL_SEMAPHORE:
+            entry = await asyncio.to_thread(extract_info, url)
+        if replayable(entry[0]):
+            INFO_CACHE[url] = entry
+    return entry
+
+def replay_ydl(ydl_opts, cookies):
+    # Media URLs may only work with the cookies the extractor received
+    ydl = YoutubeDL(ydl_opts)
+    for cookie in cookies:
+        ydl.cookiejar.set_cookie(cookie)
+    return ydl
+
+def selected_size(entry, ydl_opts):
+    # Run format selection without downloading and sum the reported sizes
+    info, cookies = entry
+    with replay_ydl(ydl_opts, cookies) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    formats = selected.get("requested_formats") or [selected]
+    sizes = [f.get("filesize") or f.get("filesize_approx") for f in formats]
+    return None if None in sizes else sum(sizes)
+
+async def estimate_size(url, entry, ydl_opts):
+    # Processing a one-shot result here would consume it before the download
+    if not replayable(entry[0]):
+        return None
+    # Format selection can still hit the site (e.g. to resolve manifests)
+    async with host_semaphore(url), YDL_SEMAPHORE:
+        return await asyncio.to_thread(selected_size, entry, ydl_opts)
+
+def download_file(url, entry, ydl_opts):
+    # Blocking download; returns the path of the file to send, or None
+    if entry is None:
+        # Retry after throttling: extract, select and download in one instance
+        with YoutubeDL(ydl_opts) as ydl:
+            result = ydl.extract_info(url, download=True)
+    else:
+        info, cookies = entry
+        if replayable(info):
+            # Cached info is shared with later requests, so process a copy
+            info = copy.deepcopy(info)
+        with replay_ydl(ydl_opts, cookies) as ydl:
+            result = ydl.process_ie_result(info, download=True)
+    if ydl_opts.get("skip_download"):
+        return downloaded_thumbnail(result)
+    return downloaded_file(result)
+
+async def download(url, entry, ydl_opts):
+    async with host_semaphore(url), YDL_SEMAPHORE:
+        try:
+            return await asyncio.to_thread(download_file, url, entry, ydl_opts)
+        except ThrottledDownload:
+            # Processing pre-extracted info skips yt-dlp's own re-extract-on-throttle,
+            # so drop any cached formats and retry once with a fresh extraction
+            logger.info(f"Download throttled, re-extracting {url}")
+            INFO_CACHE.pop(url, None)
+            return await asyncio.to_thread(download_file, url, None, ydl_opts)
+
+def result_items(result):
+    # Playlist/multi_video results (tweets with several videos, carousels) keep paths on their entries
+    return [result, *(item for item in result.get("entries") or [] if item)]
+
+def downloaded_file(result):
+    # yt-dlp records the final path (after merging/post-processing) per requested download
+    for item in result_items(result):
+        for entry in item.get("requested_downloads") or []:
+            filepath = entry.get("filepath")
+            if filepath and os.path.exists(filepath):
+                return filepath
+    return None
+
+def downloaded_thumbnail(result):
+    # Written thumbnails get their path recorded on the shared thumbnails list
+    for item in result_items(result):
+        for thumbnail in item.get("thumbnails") or []:
+            filepath = thumbnail.get("filepath")
+            if (
+                filepath
+                and filepath.endswith((".jpg", ".png", ".jpeg"))
+                and os.path.exists(filepath)
+            ):
+                return filepath
+    return None
+
+# glibc only: hands freed heap pages back to the OS
+try:
+    MALLOC_TRIM = ctypes.CDLL("libc.so.6").malloc_trim
+except (OSError, AttributeError):
+    MALLOC_TRIM = None
+
+# Downloads currently between temp-dir creation and cleanup in handle_media_type
+ACTIVE_DOWNLOADS = 0
+
+async def release_memory():
+    # Large info dicts and upload buffers otherwise keep RSS high after a download.
+    # Skipped while other downloads run: their allocations would refill the heap anyway.
+    if ACTIVE_DOWNLOADS:
+        return
+    gc.collect(0)
+    if MALLOC_TRIM is not None:
+        # malloc_trim releases the GIL, so it is worth running off the event loop
+        await asyncio.to_thread(MALLOC_TRIM, 0)
+
+async def send_media(message, media_type, path):
+    data = await asyncio.to_thread(Path(path).read_bytes)
+    filename = os.path.basename(path)
+    if media_type == "video":
+        await message.reply_video(
+            video=data, filename=filename, write_timeout=UPLOAD_TIMEOUT
+        )
+    elif media_type == "audio":
+        await message.reply_audio(
+            audio=data, filename=filename, write_timeout=UPLOAD_TIMEOUT
+        )
+    else:
+        await message.reply_photo(
+            photo=data, filename=filename, write_timeout=UPLOAD_TIMEOUT
+        )
+
+# Command handlers
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(WELCOME_TEXT)
+    logger.info(f"Start command by user {update.message.from_user.id}")
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(HELP_TEXT)
     logger.info(f"Help command by user {update.message.from_user.id}")
 
 # Handle URLs
@@ -55,203 +306,155 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     url = update.message.text.strip()
     logger.info(f"Received URL from user {user_id}: {url}")
 
-    # Store the URL in context for media type selection
-    request_id = str(user_id) + "_" + str(int(time.time()))
-    context.bot_data[request_id] = {"url": url}
+    # Store the URL in the user's own data for media type selection
+    context.user_data["pending_url"] = url
 
     # Ask for media type
     await update.message.reply_text(
         "Select media type to download (reply with one):\n- Video\n- Audio\n- Image"
     )
 
+# Handle any other text (partial words, sentences with links, ...)
+async def handle_other_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "Send a single video link, then reply with Video, Audio, or Image."
+    )
+
 # Handle media type selection
 async def handle_media_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global ACTIVE_DOWNLOADS
     user_id = update.message.from_user.id
     text = update.message.text.lower().strip()
     logger.info(f"Received media type from user {user_id}: {text}")
 
-    # Find the latest request_id for this user
-    request_id = None
-    for key in context.bot_data.keys():
-        if key.startswith(str(user_id) + "_"):
-            request_id = key
-            break
+    media_type = text
 
-    if not request_id or request_id not in context.bot_data:
+    # Claim the user's pending URL so a repeated reply can't start a second download
+    url = context.user_data.pop("pending_url", None)
+    if not url:
         await update.message.reply_text("Session expired. Please send the URL again.")
         logger.warning(f"Session expired for user {user_id}")
         return
 
-    url = context.bot_data[request_id]["url"]
-    media_type = text
+    media = MEDIA_TYPES[media_type]
+    label = media_type.capitalize()
+    max_bytes = media["max_mb"] * 1024 * 1024
 
-    if media_type not in ["video", "audio", "image"]:
-        await update.message.reply_text("Please reply with Video, Audio, or Image.")
-        return
+    # Each request downloads into its own directory so concurrent jobs never collide
+    workdir = tempfile.mkdtemp(prefix="dl_")
+    ACTIVE_DOWNLOADS += 1
 
     # Download the selected media type
     try:
-        if media_type == "video":
-            ydl_opts = {
-                "format": "bestvideo+bestaudio/best",
-                "outtmpl": "video.%(ext)s",
-                "quiet": True,
-                "no-check-certificate": True,
-                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "geo_bypass": True,
-                "no_playlist": True,
-                "retries": 3,
-                "extractor_retries": 3,
-            }
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-
-            video_file = None
-            for file in os.listdir():
-                if file.startswith("video."):
-                    video_file = file
-                    break
-
-            if not video_file:
-                await update.message.reply_text("Error: Video file not found.")
-                del context.bot_data[request_id]
-                logger.warning(f"No video file for URL {url}")
-                return
-
-            file_size = os.path.getsize(video_file) / (1024 * 1024)  # Size in MB
-            if file_size <= 50:
-                with open(video_file, "rb") as f:
-                    await update.message.reply_video(video=f)
-                await update.message.reply_text("Video download complete!")
-            else:
+        entry = await get_info(url)
+        ydl_opts = {
+            **YDL_BASE_OPTS,
+            **media["ydl_opts"],
+            "outtmpl": os.path.join(workdir, f"{media_type}.%(ext)s"),
+        }
+
+        if not ydl_opts.get("skip_download"):
+            estimated = await estimate_size(url, entry, ydl_opts)
+            if estimated and estimated > max_bytes:
                 await update.message.reply_text(
-                    f"Video size ({file_size:.2f} MB) exceeds Telegram's 50 MB limit. Try a smaller video."
+                    f"{label} size (~{estimated / (1024 * 1024):.2f} MB) exceeds Telegram's {media['max_mb']} MB limit. Try a smaller {media_type}."
                 )
-
-            os.remove(video_file)
-            del context.bot_data[request_id]
-            logger.info(f"Video download complete for user {user_id}, URL: {url}")
-
-        elif media_type == "audio":
-            ydl_opts = {
-                "format": "bestaudio/best",
-                "outtmpl": "audio.%(ext)s",
-                "quiet": True,
-                "no-check-certificate": True,
-                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "geo_bypass": True,
-                "no_playlist": True,
-                "retries": 3,
-                "extractor_retries": 3,
-            }
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-
-            audio_file = None
-            for file in os.listdir():
-                if file.startswith("audio."):
-                    audio_file = file
-                    break
-
-            if not audio_file:
-                await update.message.reply_text("Error: Audio file not found.")
-                del context.bot_data[request_id]
-                logger.warning(f"No audio file for URL {url}")
+                logger.info(f"Skipped oversized {media_type} for user {user_id}, URL: {url}")
                 return
 
-            file_size = os.path.getsize(audio_file) / (1024 * 1024)  # Size in MB
-            if file_size <= 50:
-                with open(audio_file, "rb") as f:
-                    await update.message.reply_audio(audio=f)
-                await update.message.reply_text("Audio download complete!")
-            else:
-                await update.message.reply_text(
-                    f"Audio size ({file_size:.2f} MB) exceeds Telegram's 50 MB limit. Try a smaller audio."
-                )
+        media_file = await download(url, entry, ydl_opts)
 
-            os.remove(audio_file)
-            del context.bot_data[request_id]
-            logger.info(f"Audio download complete for user {user_id}, URL: {url}")
-
-        elif media_type == "image":
-            ydl_opts = {
-                "write_thumbnail": True,
-                "skip_download": True,  # Only download thumbnail
-                "outtmpl": "image.%(ext)s",
-                "quiet": True,
-                "no-check-certificate": True,
-                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "geo_bypass": True,
-                "no_playlist": True,
-                "retries": 3,
-                "extractor_retries": 3,
-            }
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-
-            image_file = None
-            for file in os.listdir():
-                if file.startswith("image.") and file.endswith((".jpg", ".png", ".jpeg")):
-                    image_file = file
-                    break
-
-            if not image_file:
-                await update.message.reply_text(
-                    "Error: No image found. Ensure the URL contains a downloadable image."
-                )
-                del context.bot_data[request_id]
-                logger.warning(f"No image file for URL {url}")
-                return
+        if not media_file:
+            await update.message.reply_text(media["not_found"])
+            logger.warning(f"No {media_type} file for URL {url}")
+            return
 
-            file_size = os.path.getsize(image_file) / (1024 * 1024)  # Size in MB
-            if file_size <= 10:
-                with open(image_file, "rb") as f:
-                    await update.message.reply_photo(photo=f)
-                await update.message.reply_text("Image download complete!")
-            else:
-                await update.message.reply_text(
-                    f"Image size ({file_size:.2f} MB) exceeds Telegram's 10 MB limit."
-                )
+        file_size = os.stat(media_file).st_size  # Size in bytes
+        if file_size <= max_bytes:
+            await send_media(update.message, media_type, media_file)
+            await update.message.reply_text(f"{label} download complete!")
+        else:
+            await update.message.reply_text(
+                f"{label} size ({file_size / (1024 * 1024):.2f} MB) exceeds Telegram's {media['max_mb']} MB limit. Try a smaller {media_type}."
+            )
 
-            os.remove(image_file)
-            del context.bot_data[request_id]
-            logger.info(f"Image download complete for user {user_id}, URL: {url}")
+        logger.info(f"{label} download complete for user {user_id}, URL: {url}")
 
     except Exception as e:
         logger.error(f"Error downloading {media_type} from {url}: {e}")
         await update.message.reply_text(
             f"Error downloading {media_type}: {str(e)}. Try a different URL."
         )
-        for file in os.listdir():
-            if file.startswith(("video.", "audio.", "image.")):
-                os.remove(file)
-        del context.bot_data[request_id]
+    finally:
+        await asyncio.to_thread(shutil.rmtree, workdir, ignore_errors=True)
+        ACTIVE_DOWNLOADS -= 1
+        await release_memory()
 
 def main():
+    start_log_listener()
+
+    if not TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN is not set")
+        sys.exit(1)
+
+    # Prefer uvloop's faster event loop where it is installed (not available on Windows)
+    if sys.platform != "win32":
+        try:
+            import uvloop
+        except ImportError:
+            logger.info("uvloop not installed, using the default asyncio loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # Create the Application
     try:
-        application = Application.builder().token(TOKEN).build()
+        # Handle updates concurrently so one user's download doesn't queue everyone else
+        application = (
+            Application.builder()
+            .token(TOKEN)
+            .concurrent_updates(True)
+            # Concurrent handlers share the HTTP pool; wait for a free connection instead of failing
+            .pool_timeout(30)
+            .connect_timeout(20)
+            .read_timeout(60)
+            .write_timeout(UPLOAD_TIMEOUT)
+            .build()
+        )
     except Exception as e:
         logger.error(f"Failed to create application: {e}")
         return
 
-    # Clear webhook to prevent conflicts
-    try:
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(application.bot.delete_webhook())
-        logger.info("Webhook cleared to prevent conflicts")
-    except Exception as e:
-        logger.error(f"Error clearing webhook: {e}")
-
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url))
-    application.add_handler(MessageHandler(filters.Regex(r'^(video|audio|image)$'), handle_media_type))
+    application.add_handler(MessageHandler(filters.Regex(MEDIA_TYPE_RE), handle_media_type))
+    # Only URL-shaped messages reach handle_url
+    application.add_handler(MessageHandler(filters.Regex(URL_RE), handle_url))
+    # Other text gets usage help in private chats only; group chatter is dropped at the filter
+    application.add_handler(
+        MessageHandler(
+            filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
+            handle_other_text,
+        )
+    )
 
     # Start the bot
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WEBHOOK_URL:
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=int(os.getenv("PORT", "8443")),
+                url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+                webhook_url=WEBHOOK_URL,
+                secret_token=os.getenv("WEBHOOK_SECRET"),
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True,
+            )
+        else:
+            # Polling clears any webhook on startup; also drop updates queued while offline
+            application.run_polling(
+                allowed_updates=Update.ALL_TYPES, drop_pending_updates=True
+            )
         logger.info("Bot started successfully")
     except Exception as e:
         logger.error(f"Error starting bot: {e}")